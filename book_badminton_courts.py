@@ -21,14 +21,21 @@ Options:
     --email-list <str>   comma separated emails, to send notifications of booked courts
 """
 
+import functools
+import inspect
+import io
+import re
 import requests
-import html
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 import os
 import json
 import logging
 from docopt import docopt
-from bs4 import BeautifulSoup
+from lxml import etree
 
 # Google calender API
 import pickle
@@ -40,11 +47,62 @@ from google.auth.transport.requests import Request
 logging.basicConfig(format="%(asctime)s %(levelname)s: %(message)s")
 logger = logging.getLogger(__name__)
 
-try:
-    COOKIES = json.loads(os.environ.get("COOKIES"))
-except json.decoder.JSONDecodeError as err:
-    logger.error(f"Failed to parse Cookies: {err}")
-    exit(1)
+# The availability page is machine generated: each free slot is a
+# <div class="book-item ..."> directly followed by its <input name="HH:MM">
+BOOK_ITEM_PATTERN = re.compile(
+    rb'class="([^"]*(?<![\w-])book-item(?![\w-])[^"]*)"[^>]*>\s*'
+    rb'<input[^>]*name="([^"]+)"'
+)
+BOOK_ITEM_CLASS_PATTERN = re.compile(rb"(?<![\w-])book-item(?![\w-])")
+
+# urllib3 renamed method_whitelist to allowed_methods in 1.26 and dropped
+# the old name in 2.0, so pick whichever this version understands
+if "allowed_methods" in inspect.signature(Retry.__init__).parameters:
+    RETRY_METHODS_KWARG = "allowed_methods"
+else:
+    RETRY_METHODS_KWARG = "method_whitelist"
+
+SESSION = requests.Session()
+SESSION.headers.update({"User-Agent": "badminton-courts-booker"})
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=16,
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.3,
+            status_forcelist=[502, 503, 504],
+            **{RETRY_METHODS_KWARG: ["GET", "POST"]},
+        ),
+    ),
+)
+
+# Booking submits are not idempotent: a 5xx or read error may arrive after
+# the court was already booked, so only retry failures to connect.
+BOOKING_SESSION = requests.Session()
+BOOKING_SESSION.headers.update(SESSION.headers)
+BOOKING_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_maxsize=16,
+        max_retries=Retry(total=3, read=0, status=0, backoff_factor=0.3),
+    ),
+)
+
+
+@functools.lru_cache(maxsize=1)
+def get_cookies():
+    cookies = os.environ.get("COOKIES")
+    if not cookies:
+        logger.error("Missing Cookies: set the COOKIES environmental variable")
+        exit(1)
+
+    try:
+        return json.loads(cookies)
+    except json.decoder.JSONDecodeError as err:
+        logger.error(f"Failed to parse Cookies: {err}")
+        exit(1)
 
 
 def get_available_slots(date: str, time_slots):
@@ -59,90 +117,121 @@ def get_available_slots(date: str, time_slots):
         "psActId": "",
         "psHour": "",
     }
-    res = requests.post(url, data=data)
-    html_doc = html.unescape(res.text)
+    res = SESSION.post(url, data=data)
 
-    soup = BeautifulSoup(html_doc, "html.parser")
-    available_items_html = soup.find_all("div", attrs={"class": "book-item"})
     available_time_slots = {}
-    for available_item_html in available_items_html:
-        time_slot = available_item_html.find("input")["name"]
+    for classes, time_slot in iter_book_items(res):
         if time_slot not in time_slots:
             continue
 
-        if "last-free-lane" in available_item_html["class"]:
+        if "last-free-lane" in classes:
             time_slot = f"{time_slot} (last)"
 
-        if available_time_slots.get(date):
-            available_time_slots[date].append(time_slot)
-        else:
-            available_time_slots[date] = [time_slot]
+        available_time_slots.setdefault(date, []).append(time_slot)
 
     return available_time_slots
 
 
+def iter_book_items(res):
+    matches = BOOK_ITEM_PATTERN.findall(res.content)
+    # Only trust the regex if it matched every book-item on the page
+    if matches and len(matches) == len(BOOK_ITEM_CLASS_PATTERN.findall(res.content)):
+        for classes, time_slot in matches:
+            yield classes.decode().split(), time_slot.decode()
+        return
+
+    # Fall back to a real parser in case the markup has changed shape
+    source = io.BytesIO(res.content)
+    for book_item in iter_elements(source, "div", "book-item", res.encoding):
+        yield book_item.get("class").split(), book_item.find(".//input").get("name")
+
+
+def iter_elements(source, tag, class_name, encoding=None):
+    # Parse the source incrementally, yielding only the elements with the
+    # given tag and class. Each one is cleared once consumed.
+    try:
+        for _, elem in etree.iterparse(source, html=True, tag=tag, encoding=encoding):
+            if class_name in elem.get("class", "").split():
+                yield elem
+                elem.clear()
+    except etree.XMLSyntaxError as err:
+        # e.g. an empty body, which has no elements to yield
+        logger.warning(f"Failed to parse response: {err}")
+
+
 def get_booking_times():
     logger.info("Fetching booked time slots")
     bookings_url = "https://www.sportarenan.se/min-sida/?kategori=bokningar"
 
-    res = requests.get(bookings_url, cookies=COOKIES)
+    res = SESSION.get(bookings_url, stream=True)
+    res.raw.decode_content = True
 
-    html_doc = html.unescape(res.text)
-    soup1 = BeautifulSoup(html_doc, "html.parser")
     year = datetime.now().year
 
-    booked_slots_html = soup1.find_all("tr", attrs={"class": "values"})
+    today_str = datetime.now().strftime("%Y-%m-%d")
+    booked_times = defaultdict(lambda: defaultdict(int))
+    for booked_slot_html in iter_elements(res.raw, "tr", "values", res.encoding):
+        # Each cell holds two lines of text separated by a <br>
+        tds = booked_slot_html.findall("td")
 
-    booked_times = {}
-    for booked_slot_html in booked_slots_html:
-
-        if booked_slot_html.find_all("td")[0].contents[0] == "Idag":
-            date = datetime.now().strftime("%Y-%m-%d")
+        if tds[0].text == "Idag":
+            date = today_str
         else:
-            date = booked_slot_html.find_all("td")[0].contents[2]
+            date = tds[0][0].tail
             date = f"{year}/{date}"
             date = datetime.strptime(date, "%Y/%d/%m").strftime("%Y-%m-%d")
 
-        if not booked_times.get(date):
-            booked_times[date] = {}
-
-        start_time = booked_slot_html.find_all("td")[1].contents[0]
-        duration = booked_slot_html.find_all("td")[1].contents[2][0]
-        start_time_obj = datetime.strptime(start_time, "%H:%M")
+        start_time = tds[1].text
+        duration = tds[1][0].tail[0]
+        start_hour, start_minute = map(int, start_time.split(":"))
 
         for i in range(int(duration)):
-            next_start_time_obj = start_time_obj + timedelta(hours=i)
-            next_start_time = next_start_time_obj.strftime("%H:%M")
-
-            if not booked_times[date].get(next_start_time):
-                booked_times[date][next_start_time] = 0
-
+            next_start_time = f"{start_hour + i:02d}:{start_minute:02d}"
             booked_times[date][next_start_time] += 1
 
+    booked_times = {date: dict(slots) for date, slots in booked_times.items()}
     logger.info(f"Booked slots: {booked_times}")
     return booked_times
 
 
 def check_book_time_slots(availability, booked, num_of_courts, email_list):
     logger.info("Checking if they are any bookable slots")
+    today_str = datetime.now().strftime("%Y-%m-%d")
+    booked_dates = []
+    updated_booked = dict(booked)
+    # Drop the " (last)" marker so last-lane slots match the booked times
+    availability_sets = {
+        date: {slot.split(" ")[0] for slot in slots}
+        for date, slots in availability.items()
+    }
     for date, time_slots in booked.items():
         bookable_time_slots = [
             key for key, val in time_slots.items() if val < num_of_courts
         ]
-        if not availability.get(date):
-            continue
-        if any(
-            time_slot in availability.get(date) for time_slot in bookable_time_slots
-        ):
-            book_time_slots(date, bookable_time_slots)
-            generate_calendar_event(date, email_list)
+        available_time_slots = availability_sets.get(date, set()).intersection(
+            bookable_time_slots
+        )
+        if available_time_slots:
+            if book_time_slots(date, bookable_time_slots, today_str):
+                # Keep the booked counts current for the calendar events
+                updated_booked[date] = dict(time_slots)
+                for time_slot in available_time_slots:
+                    updated_booked[date][time_slot] += 1
+            booked_dates.append(date)
+
+    if booked_dates:
+        generate_calendar_events(
+            get_calendar_service(), booked_dates, email_list, updated_booked
+        )
 
 
-def book_time_slots(date, time_slots):
+def book_time_slots(date, time_slots, today_str=None):
     logger.info(f"Booking {date}: {time_slots}")
-    if date == datetime.now().strftime("%Y-%m-%d"):
+    if today_str is None:
+        today_str = datetime.now().strftime("%Y-%m-%d")
+    if date == today_str:
         logger.warning(f"Skipped booking slots for the same date:{date}")
-        return
+        return False
 
     url = "https://www.sportarenan.se/wp-content/themes/sportarenan/sportarenan-functions/wb/list_free_courts.php"
     data = {
@@ -158,26 +247,37 @@ def book_time_slots(date, time_slots):
         data[time_slot] = f"2-{time_slot}"
 
     try:
-        response = requests.post(url, data=data, cookies=COOKIES)
+        response = BOOKING_SESSION.post(url, data=data)
         response.raise_for_status()
-    except (requests.exceptions.HTTPError, requests.exceptions.Timeout) as e:
+    except (
+        requests.exceptions.HTTPError,
+        requests.exceptions.Timeout,
+        requests.exceptions.ConnectionError,
+        requests.exceptions.RetryError,
+    ) as e:
         logger.error(
             f"Failed to book time slots:{time_slots}. on {date} \n Error: {str(e)}"
         )
+        return False
+    return True
 
 
 def get_available_slots_upto_given_days(days: int, time_slots):
     logger.info(f"Fetch available time slots for the next {days} days")
     today = datetime.now()
-    availability = {}
-    for i in range(days):
-        req_date = today + timedelta(days=i)
-
-        if req_date.weekday() > 4:
-            continue
+    req_dates = [today + timedelta(days=i) for i in range(days)]
+    req_dates = [
+        req_date.strftime("%Y-%m-%d")
+        for req_date in req_dates
+        if req_date.weekday() <= 4
+    ]
 
-        req_date = req_date.strftime("%Y-%m-%d")
-        availability.update(get_available_slots(req_date, time_slots))
+    availability = {}
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        for available_slots in executor.map(
+            lambda req_date: get_available_slots(req_date, time_slots), req_dates
+        ):
+            availability.update(available_slots)
     logger.info(f"Available slots: {availability}")
     return availability
 
@@ -193,23 +293,25 @@ def book_courts_on_desired_date(days, time_slots, num_of_courts, email_list):
     req_date = today + timedelta(days=days)
     req_date = req_date.strftime("%Y-%m-%d")
 
-    for _ in range(num_of_courts):
-        book_time_slots(req_date, time_slots)
+    # Each request books a single court, so submit one per court at once
+    with ThreadPoolExecutor(max_workers=max(num_of_courts, 1)) as executor:
+        futures = [
+            executor.submit(book_time_slots, req_date, time_slots)
+            for _ in range(num_of_courts)
+        ]
+    # Re-raise anything book_time_slots didn't handle itself
+    for future in futures:
+        future.result()
 
-    generate_calendar_event(req_date, email_list)
+    generate_calendar_event(get_calendar_service(), req_date, email_list)
 
 
 def get_time_slots(start_time, duration):
-    timeslots = [start_time]
-    for _ in range(1, duration):
-        start_time_obj = datetime.strptime(start_time, "%H:%M")
-        next_time_obj = start_time_obj + timedelta(hours=1)
-        next_time = next_time_obj.strftime("%H:%M")
-        timeslots.append(next_time)
-        start_time = next_time
-    return timeslots
+    start_hour, start_minute = map(int, start_time.split(":"))
+    return [f"{start_hour + i:02d}:{start_minute:02d}" for i in range(duration)]
 
 
+@functools.lru_cache(maxsize=1)
 def get_calendar_service():
     # code from quickstart page: https://developers.google.com/calendar/api/quickstart/python
 
@@ -235,42 +337,24 @@ def get_calendar_service():
             creds = flow.run_local_server(port=0)
         with open(token_file, "wb") as token:
             pickle.dump(creds, token)
-    service = build("calendar", "v3", credentials=creds)
+    service = build("calendar", "v3", credentials=creds, cache_discovery=False)
     return service
 
 
-def get_booked_time_slot(date):
-    booked_times = get_booking_times()
-    return booked_times.get(date)
-
-
-def get_badminton_event(date):
-    service = get_calendar_service()
-
+def list_badminton_events(service, date):
     date_obj = datetime.strptime(date, "%Y-%m-%d")
-    day_start_time = (
-        datetime(
-            date_obj.year, date_obj.month, date_obj.day, hour=0, minute=0
-        ).isoformat()
-        + "Z"
-    )
-    day_end_time = (
-        datetime(
-            date_obj.year, date_obj.month, date_obj.day, hour=23, minute=59
-        ).isoformat()
-        + "Z"
-    )
-    events_result = (
-        service.events()
-        .list(
-            calendarId="primary",
-            timeMin=day_start_time,
-            timeMax=day_end_time,
-            singleEvents=True,
-            orderBy="startTime",
-        )
-        .execute()
+    day_start_time = date_obj.strftime("%Y-%m-%dT00:00:00Z")
+    day_end_time = date_obj.strftime("%Y-%m-%dT23:59:00Z")
+    return service.events().list(
+        calendarId="primary",
+        timeMin=day_start_time,
+        timeMax=day_end_time,
+        singleEvents=True,
+        orderBy="startTime",
     )
+
+
+def get_badminton_event_id(events_result):
     events = events_result.get("items", [])
 
     for event in events:
@@ -280,40 +364,44 @@ def get_badminton_event(date):
 
 
 def update_calendar_event(service, event_id, event_body):
-    event_result = (
-        service.events()
-        .update(
-            calendarId="primary",
-            eventId=event_id,
-            body=event_body,
-        )
-        .execute()
-    )
-    logger.info(
-        f"Updated event: {event_result['summary']}. Time: {event_result['start']['dateTime']} - {event_result['end']['dateTime']}"
+    return service.events().update(
+        calendarId="primary",
+        eventId=event_id,
+        body=event_body,
     )
 
 
 def create_calender_event(service, event_body):
-    event_result = (
-        service.events()
-        .insert(
-            calendarId="primary",
-            body=event_body,
-        )
-        .execute()
+    return service.events().insert(
+        calendarId="primary",
+        body=event_body,
+    )
+
+
+def log_updated_event(date, event_result, exception):
+    if exception is not None:
+        logger.error(f"Failed to update event on {date}: {exception}")
+        return
+    logger.info(
+        f"Updated event: {event_result['summary']}. Time: {event_result['start']['dateTime']} - {event_result['end']['dateTime']}"
     )
 
+
+def log_created_event(date, event_result, exception):
+    if exception is not None:
+        logger.error(f"Failed to create event on {date}: {exception}")
+        return
     logger.info(
         f"created event: {event_result['summary']}. Time: {event_result['start']['dateTime']} - {event_result['end']['dateTime']}"
     )
 
 
-def generate_calendar_event(date, email_list=[]):
-    service = get_calendar_service()
-    time_slots = get_booked_time_slot(date)
+def get_calendar_event_body(date, booked, email_list=[], today_str=None):
+    time_slots = booked.get(date)
 
-    if date == datetime.now().strftime("%Y-%m-%d"):
+    if today_str is None:
+        today_str = datetime.now().strftime("%Y-%m-%d")
+    if date == today_str:
         logger.warning(f"Skipped creating event for the same date:{date}")
         return
 
@@ -328,7 +416,7 @@ def generate_calendar_event(date, email_list=[]):
     end_time = start_time + timedelta(hours=duration)
     attendees = [{"email": email} for email in email_list]
 
-    event_body = {
+    return {
         "summary": f"Badminton {list(time_slots.values())} (A)",
         "description": "This is an automated event",
         "start": {
@@ -349,14 +437,62 @@ def generate_calendar_event(date, email_list=[]):
         "attendees": attendees,
     }
 
-    event_id = get_badminton_event(date)
-    if event_id:
-        update_calendar_event(service, event_id, event_body)
-    else:
-        create_calender_event(service, event_body)
+
+def generate_calendar_events(service, dates, email_list=[], booked=None):
+    if booked is None:
+        booked = get_booking_times()
+
+    today_str = datetime.now().strftime("%Y-%m-%d")
+    event_bodies = {}
+    for date in dates:
+        event_body = get_calendar_event_body(date, booked, email_list, today_str)
+        if event_body:
+            event_bodies[date] = event_body
+
+    if not event_bodies:
+        return
+
+    # Look up existing events for every date in one batch, then create or
+    # update them all in a second batch.
+    event_ids = {}
+
+    def store_event_id(date, events_result, exception):
+        if exception is not None:
+            logger.error(f"Failed to fetch events on {date}: {exception}")
+            return
+        event_ids[date] = get_badminton_event_id(events_result)
+
+    batch = service.new_batch_http_request(callback=store_event_id)
+    for date in event_bodies:
+        batch.add(list_badminton_events(service, date), request_id=date)
+    batch.execute()
+
+    batch = service.new_batch_http_request()
+    for date, event_body in event_bodies.items():
+        if date not in event_ids:
+            continue
+
+        event_id = event_ids[date]
+        if event_id:
+            batch.add(
+                update_calendar_event(service, event_id, event_body),
+                callback=log_updated_event,
+                request_id=date,
+            )
+        else:
+            batch.add(
+                create_calender_event(service, event_body),
+                callback=log_created_event,
+                request_id=date,
+            )
+    batch.execute()
     logger.info(f"Attendes: {str(email_list)}")
 
 
+def generate_calendar_event(service, date, email_list=[], booked=None):
+    generate_calendar_events(service, [date], email_list, booked)
+
+
 def setup_logger(_logger):
     _logger.setLevel(logging.INFO)
 
@@ -372,11 +508,14 @@ def main():
     args = docopt(__doc__)
 
     setup_logger(logger)
+    SESSION.cookies.update(get_cookies())
+    BOOKING_SESSION.cookies.update(get_cookies())
     start_time = args["--start-time"]
     duration = int(args["--duration"])
     courts = int(args["--courts"])
     email_list = args["--email-list"].split(",") if args["--email-list"] else []
     time_slots = get_time_slots(start_time, duration)
+    time_slot_set = frozenset(time_slots)
 
     if args["--book-courts"]:
         logger.info(
@@ -389,7 +528,7 @@ def main():
         logger.info(
             f"Fill courts with start time {start_time}, duration: {duration} & courts: {courts}"
         )
-        book_from_booked_times(time_slots, courts, email_list)
+        book_from_booked_times(time_slot_set, courts, email_list)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,28 @@
+import unittest
+from unittest import mock
+
+import book_badminton_courts
+
+
+class CheckBookTimeSlotsTest(unittest.TestCase):
+    @mock.patch.object(book_badminton_courts, "generate_calendar_events")
+    @mock.patch.object(book_badminton_courts, "get_calendar_service")
+    @mock.patch.object(book_badminton_courts, "book_time_slots", return_value=True)
+    def test_last_lane_slot_is_counted_as_booked(
+        self, book_time_slots, get_calendar_service, generate_calendar_events
+    ):
+        booked = {"2026-10-20": {"17:00": 1, "18:00": 1}}
+        availability = {"2026-10-20": ["17:00 (last)", "18:00"]}
+
+        book_badminton_courts.check_book_time_slots(availability, booked, 2, [])
+
+        book_time_slots.assert_called_once_with(
+            "2026-10-20", ["17:00", "18:00"], mock.ANY
+        )
+        updated_booked = generate_calendar_events.call_args.args[3]
+        self.assertEqual(updated_booked, {"2026-10-20": {"17:00": 2, "18:00": 2}})
+        self.assertEqual(booked, {"2026-10-20": {"17:00": 1, "18:00": 1}})
+
+
+if __name__ == "__main__":
+    unittest.main()